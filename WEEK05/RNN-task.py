@@ -12,16 +12,27 @@
 # In[1]:
 
 
-import tensorflow as tf
+import os
+# let XLA compile the graph (on CPU as well): fuses matmul + bias + relu of the rnn step
+# and the softmax cross-entropy into fewer kernels; must be set before tensorflow is imported
+os.environ.setdefault('TF_XLA_FLAGS', '--tf_xla_auto_jit=2 --tf_xla_cpu_global_jit')
+# this notebook is written in graph mode: on TF 2.x keep running it that way,
+# eager execution and control flow v2 make the same RNN training noticeably slower.
+# On TF >= 2.16 `tf.keras` is Keras 3, whose layers can't be applied to graph tensors,
+# so ask for the legacy tf.keras (the `tf_keras` package) instead
+os.environ.setdefault('TF_USE_LEGACY_KERAS', '1')
+import tensorflow.compat.v1 as tf
+tf.disable_eager_execution()
+tf.disable_control_flow_v2()
 print(tf.__version__)
 import numpy as np
 import matplotlib.pyplot as plt
 get_ipython().magic('matplotlib inline')
-import os
 import sys
+import hashlib
+import pickle
+import tempfile
 sys.path.append("..")
-import keras_utils
-import tqdm_utils
 
 
 # # Load data
@@ -39,9 +50,52 @@ start_token = " "  # so that the network knows that we're generating a first tok
 # to make them of equal size for further batching
 pad_token = "#"
 
-with open("names") as f:
-    names = f.read()[:-1].split('\n')
-    names = [start_token + name for name in names]
+
+# bump it whenever preprocessing of names or of their id matrix changes, so that stale caches are not reused
+cache_version = 1
+
+
+def write_atomically(path, write):
+    """
+    Calls `write` with a binary file next to `path` and moves that file to `path` once it is complete,
+    so an interrupted write never leaves a truncated cache behind.
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            write(f)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def prepare(path):
+    """
+    Reads names from `path` and collects their vocabulary and max length.
+    Names, vocabulary and max length are cached in a pickle keyed by the file (path, size, modification time)
+    and by the preprocessing parameters, so a dataset is only read and scanned once, not on every notebook restart.
+    """
+    stat = os.stat(path)
+    cache_key = hashlib.md5(repr((os.path.abspath(path), stat.st_size, stat.st_mtime_ns,
+                                  start_token, pad_token, cache_version)).encode()).hexdigest()
+    cache_path = '.cache_%s.pkl' % cache_key
+    if os.path.exists(cache_path):
+        with open(cache_path, 'rb') as f:
+            return (cache_key,) + pickle.load(f)
+    
+    with open(path, encoding='utf-8') as f:
+        names = [start_token + name for name in f.read()[:-1].split('\n')]
+    # all unique characters, padding included; sorted, so that token ids are the same from run to run
+    tokens = sorted(set(''.join(names)) | {pad_token})
+    token_to_id = {token: i for i, token in enumerate(tokens)}
+    max_length = max(map(len, names))
+    write_atomically(cache_path, lambda f: pickle.dump((names, tokens, token_to_id, max_length), f))
+    
+    return cache_key, names, tokens, token_to_id, max_length
+
+
+cache_key, names, tokens, token_to_id, MAX_LENGTH = prepare("names")
 
 
 # In[3]:
@@ -55,7 +109,8 @@ for x in names[::1000]:
 # In[4]:
 
 
-MAX_LENGTH = max(map(len, names))
+# round up to a multiple of 8 so that matmul shapes fit Tensor Core tiles
+MAX_LENGTH = (MAX_LENGTH + 7) & ~7
 print("max length:", MAX_LENGTH)
 
 plt.title('Sequence length distribution')
@@ -69,9 +124,7 @@ plt.hist(list(map(len, names)), bins=25);
 # In[5]:
 
 
-tokens = set(''.join(names[:]))### YOUR CODE HERE: all unique characters go here, padding included!
-
-tokens = list(tokens)
+# all unique characters, padding included, are collected by `prepare` above
 n_tokens = len(tokens)
 print ('n_tokens:', n_tokens)
 
@@ -83,29 +136,36 @@ assert 50 < n_tokens < 60
 # Tensorflow string manipulation is a bit tricky, so we'll work around it. 
 # We'll feed our recurrent neural network with ids of characters from our dictionary.
 # 
-# To create such dictionary, let's assign `token_to_id`
+# Such dictionary `token_to_id` {symbol -> its index in tokens} is also built by `prepare`.
 
 # In[7]:
 
 
-token_to_id = {} ### YOUR CODE HERE: create a dictionary of {symbol -> its  index in tokens}
-for i in range(n_tokens):
-    token_to_id[tokens[i]] = i
-    
 assert len(tokens) == len(token_to_id), "dictionaries must have same size"
+assert pad_token in token_to_id, "padding must be in the vocabulary"
 
 
 # In[9]:
 
 
-def to_matrix(names, max_len=None, pad=0, dtype=np.int32):
+# lookup table {character code -> token id}, so that a whole name is converted with one numpy indexing
+# characters missing from the vocabulary are marked with -1
+token_lut = np.full(max(map(ord, tokens)) + 1, -1, np.int32)
+for token, i in token_to_id.items():
+    token_lut[ord(token)] = i
+
+
+def to_matrix(names, max_len=None, pad=token_to_id[pad_token], dtype=np.int32):
     """Casts a list of names into rnn-digestable padded matrix"""
     
     max_len = max_len or max(map(len, names))
-    names_ix = np.zeros([len(names), max_len], dtype) + pad
+    names_ix = np.full([len(names), max_len], pad, dtype)
 
-    for i in range(len(names)):
-        name_ix = list(map(token_to_id.get, names[i]))
+    for i, name in enumerate(names):
+        codes = np.frombuffer(name.encode('utf-32-le'), np.uint32)
+        name_ix = token_lut[np.minimum(codes, len(token_lut) - 1)]
+        if (codes >= len(token_lut)).any() or (name_ix < 0).any():
+            raise KeyError("name %r has characters that are not in the vocabulary" % name)
         names_ix[i, :len(name_ix)] = name_ix
 
     return names_ix
@@ -132,17 +192,29 @@ print(to_matrix(names[::2000]))
 
 
 # remember to reset your session if you change your graph!
-s = keras_utils.reset_tf_session()
+# the session is reset through compat.v1 here: keras_utils.reset_tf_session needs TF 1.x and standalone keras
+if tf.get_default_session() is not None:
+    tf.get_default_session().close()
+tf.keras.backend.clear_session()
+tf.reset_default_graph()
+config = tf.ConfigProto()
+config.gpu_options.allow_growth = True
+s = tf.InteractiveSession(config=config)
+tf.keras.backend.set_session(s)
 
 
 # In[13]:
 
 
-import keras
-from keras.layers import concatenate, Dense, Embedding
+# layers come from tf.keras of the compat.v1 module, so that they accept graph mode placeholders and iterator tensors
+Dense = tf.keras.layers.Dense
+Embedding = tf.keras.layers.Embedding
 
 rnn_num_units = 64  # size of hidden state
 embedding_size = 16  # for characters
+n_tokens_padded = (n_tokens + 7) // 8 * 8  # output width rounded up to a multiple of 8 for Tensor Cores
+
+assert rnn_num_units % 8 == 0 and embedding_size % 8 == 0
 
 # Let's create layers for our recurrent network
 # Note: we create layers but we don't "apply" them yet (this is a "functional API" of Keras)
@@ -151,11 +223,30 @@ embedding_size = 16  # for characters
 # an embedding layer that converts character ids into embeddings
 embed_x = Embedding(n_tokens, embedding_size)
 
-# a dense layer that maps input and previous state to new hidden state, [x_t,h_t]->h_t+1
-get_h_next = Dense(rnn_num_units, activation='relu')### YOUR CODE HERE
-
-# a dense layer that maps current hidden state to probabilities of characters [h_t+1]->P(x_t+1|h_t+1)
-get_probas = Dense(n_tokens, activation='softmax')### YOUR CODE HERE 
+# on GPU the [x_t,h_t]->h_t+1 relu recurrence is computed by cuDNN,
+# which runs all time-steps in a single fused kernel instead of one launch per step
+# tf.contrib only exists on TF 1.x: on TF 2.x the cuDNN path is never taken
+# and training always falls back to the (slower) dynamic_rnn loop below
+try:
+    from tensorflow.contrib.cudnn_rnn import CudnnRNNRelu
+except ImportError:
+    CudnnRNNRelu = None
+use_cudnn = CudnnRNNRelu is not None and tf.test.is_gpu_available(cuda_only=True)
+if use_cudnn:
+    cudnn_rnn = CudnnRNNRelu(num_layers=1, num_units=rnn_num_units)
+else:
+    # weights of a dense layer that maps input and previous state to new hidden state, [x_t,h_t]->h_t+1
+    # split into an input and a recurrent matrix, so that [x_t,h_t] never has to be concatenated
+    # AUTO_REUSE keeps this cell re-runnable without resetting the session
+    with tf.variable_scope('rnn_cell', reuse=tf.AUTO_REUSE):
+        Wx = tf.get_variable('Wx', [embedding_size, rnn_num_units])### YOUR CODE HERE
+        Wh = tf.get_variable('Wh', [rnn_num_units, rnn_num_units])### YOUR CODE HERE
+        b = tf.get_variable('b', [rnn_num_units], initializer=tf.zeros_initializer())### YOUR CODE HERE
+
+# a dense layer that maps current hidden state to logits of characters [h_t+1]->P(x_t+1|h_t+1)
+# it is n_tokens_padded wide, extra logits are sliced off before they are used
+# no activation here: softmax is fused into the loss, and sampling draws straight from logits (Gumbel-max)
+get_logits = Dense(n_tokens_padded)### YOUR CODE HERE 
 
 
 # We will generate names character by character starting with `start_token`:
@@ -165,10 +256,26 @@ get_probas = Dense(n_tokens, activation='softmax')### YOUR CODE HERE
 # In[15]:
 
 
+def rnn_cell_step(x_t_emb, h_t):
+    """
+    Recurrent neural network step that produces next state h_t+1
+    given already embedded current input x_t and previous state h_t.
+    """
+    if use_cudnn:
+        # cuDNN expects [time, batch, ...] inputs and [num_layers, batch, units] states
+        _, (h_next,) = cudnn_rnn(x_t_emb[None], initial_state=(h_t[None],))
+        return h_next[0]
+    
+    # compute next state, same as a relu dense layer applied to concatenated [x_t_emb, h_t]
+    h_next = tf.nn.relu(tf.matmul(x_t_emb, Wx) + tf.matmul(h_t, Wh) + b)### YOUR CODE HERE
+    
+    return h_next
+
+
 def rnn_one_step(x_t, h_t):
     """
     Recurrent neural network step that produces 
-    probabilities for next token x_t+1 and next state h_t+1
+    logits for next token x_t+1 and next state h_t+1
     given current input x_t and previous state h_t.
     We'll call this method repeatedly to produce the whole sequence.
     
@@ -176,48 +283,116 @@ def rnn_one_step(x_t, h_t):
     Follow inline instructions to complete the function.
     """
     # convert character id into embedding
-    x_t_emb = embed_x(tf.reshape(x_t, [-1, 1]))[:, 0]
-    
-    # concatenate x_t embedding and previous h_t state
-    x_and_h = tf.concat([x_t_emb, h_t], 1)### YOUR CODE HERE
+    x_t_emb = embed_x(x_t)
     
-    # compute next state given x_and_h
-    h_next = get_h_next(x_and_h)### YOUR CODE HERE
+    # compute next state given x_t embedding and previous state
+    h_next = rnn_cell_step(x_t_emb, h_t)
     
-    # get probabilities for language model P(x_next|h_next)
-    output_probas = get_probas(h_next)### YOUR CODE HERE
+    # get logits for language model P(x_next|h_next)
+    output_logits = get_logits(h_next)[:, :n_tokens]### YOUR CODE HERE
     
-    return output_probas, h_next
+    return output_logits, h_next
+
+
+# # RNN: input pipeline
+# 
+# Batches are served by [tf.data](https://www.tensorflow.org/api_docs/python/tf/data), which prepares the next batch while the current one is being processed.
+
+# In[ ]:
+
+
+batch_size = 32
+
+# cast all names once and sort them by length, so that neighbouring names have similar lengths
+name_lengths = np.array(list(map(len, names)), np.int32)
+order = np.argsort(name_lengths, kind='stable')
+name_lengths = name_lengths[order]
+
+# the id matrix is cached on disk next to the vocabulary and memory-mapped: rows are paged in on demand
+names_ids_path = '.cache_%s_%d_ids.npy' % (cache_key, MAX_LENGTH)
+if not os.path.exists(names_ids_path):
+    write_atomically(names_ids_path, lambda f: np.save(f, to_matrix(names, max_len=MAX_LENGTH)[order]))
+names_matrix = np.load(names_ids_path, mmap_mode='r')
+
+
+def iterate_batches():
+    """
+    Yields batches of token ids and name lengths forever.
+    Every epoch names are shuffled within each length group and cut into batches again,
+    so batches hold names of similar length but are not the same from epoch to epoch.
+    Each batch is padded only up to its longest name plus the trailing pad_token (still a multiple of 8)
+    and is read from the memory-mapped matrix when it is needed.
+    """
+    while True:
+        # rows are already sorted by length: sort by (length, random key) to shuffle inside length groups
+        epoch_order = np.lexsort((np.random.random(len(names)), name_lengths))
+        for start in np.random.permutation(np.arange(0, len(names), batch_size)):
+            # sorted row indices, so that the memory map is read front to back
+            batch_ix = np.sort(epoch_order[start:start + batch_size])
+            batch_lengths = name_lengths[batch_ix]
+            max_len = min((batch_lengths.max() + 1 + 7) // 8 * 8, MAX_LENGTH)
+            yield names_matrix[batch_ix, :max_len], batch_lengths
+
+
+# the generator runs on the tf.data background threads, so batches are prepared ahead of training
+dataset = tf.data.Dataset.from_generator(iterate_batches, (tf.int32, tf.int32),
+                                         (tf.TensorShape([None, None]), tf.TensorShape([None])))
+dataset = dataset.prefetch(tf.data.experimental.AUTOTUNE)
+
+# batch of token ids and length of each name in the batch, pads excluded
+input_sequence, sequence_lengths = tf.data.make_one_shot_iterator(dataset).get_next()
 
 
 # # RNN: loop
 # 
-# Once `rnn_one_step` is ready, let's apply it in a loop over name characters to get predictions.
+# Once the step functions are ready, let's apply the recurrence over name characters to get predictions.
 # 
-# Let's assume that all names are at most length-16 for now, so we can simply iterate over them in a for loop.
+# Instead of unrolling the loop in python (which adds a copy of the step to the graph for every time-step) we wrap the state update `rnn_cell_step` into an RNN cell and let [tf.nn.dynamic_rnn](https://www.tensorflow.org/api_docs/python/tf/nn/dynamic_rnn) run it as a single symbolic loop. The output layer is then applied to the hidden states of all time-steps at once.
 # 
 
 # In[16]:
 
 
-input_sequence = tf.placeholder(tf.int32, (None, MAX_LENGTH))  # batch of token ids
-batch_size = tf.shape(input_sequence)[0]
-
-predicted_probas = []
-h_prev = tf.zeros([batch_size, rnn_num_units])  # initial hidden state
-
-for t in range(MAX_LENGTH):
-    x_t = input_sequence[:, t]  # column t
-    probas_next, h_next = rnn_one_step(x_t, h_prev)
+class CustomRNN(tf.nn.rnn_cell.RNNCell):
+    def __init__(self, num_units):
+        super(CustomRNN, self).__init__()
+        self._num_units = num_units
     
-    h_prev = h_next
-    predicted_probas.append(probas_next)
+    def call(self, input, state):
+        # from docs:
+        # Returns:
+        # Output: A 2-D tensor with shape [batch_size, self.output_size].
+        # New state: Either a single 2-D tensor, or a tuple of tensors matching the arity and shapes of state.
+        h_next = rnn_cell_step(input, state)
+        return h_next, h_next
     
-# combine predicted_probas into [batch, time, n_tokens] tensor
-predicted_probas = tf.transpose(tf.stack(predicted_probas), [1, 0, 2])
+    @property
+    def state_size(self):
+        return self._num_units
+    
+    @property
+    def output_size(self):
+        return self._num_units
+
+
+# embed the whole batch at once, [batch, time, embedding_size]
+inputs_embedded = embed_x(input_sequence)
+
+# hidden states for each step [batch, time, rnn_num_units]
+if use_cudnn:
+    state_sequence, _ = cudnn_rnn(tf.transpose(inputs_embedded, [1, 0, 2]),
+                                  sequence_lengths=sequence_lengths)
+    state_sequence = tf.transpose(state_sequence, [1, 0, 2])
+else:
+    state_sequence, _ = tf.nn.dynamic_rnn(CustomRNN(rnn_num_units), inputs_embedded,
+                                          sequence_length=sequence_lengths,
+                                          dtype=tf.float32, time_major=False, swap_memory=True)
+
+# project all hidden states at once into [batch, time, n_tokens] tensor
+predicted_logits = get_logits(state_sequence)[:, :, :n_tokens]
 
 # next to last token prediction is not needed
-predicted_probas = predicted_probas[:, :-1, :]
+predicted_logits = predicted_logits[:, :-1, :]
 
 
 # # RNN: loss and gradients
@@ -226,32 +401,42 @@ predicted_probas = predicted_probas[:, :-1, :]
 # 
 # We will flatten our matrices to shape [None, n_tokens] to make it easier.
 # 
-# Our network can then be trained by minimizing crossentropy between predicted probabilities and those answers.
+# Our network can then be trained by minimizing crossentropy between predicted distribution and those answers.
 
 # In[17]:
 
 
 # flatten predictions to [batch*time, n_tokens]
-predictions_matrix = tf.reshape(predicted_probas, [-1, n_tokens])
+predictions_matrix = tf.reshape(predicted_logits, [-1, n_tokens])
 
-# flatten answers (next tokens) and one-hot encode them
-answers_matrix = tf.one_hot(tf.reshape(input_sequence[:, 1:], [-1]), n_tokens)
+# flatten answers (next tokens), they are kept as ids: no need to one-hot encode them
+answers_matrix = tf.reshape(input_sequence[:, 1:], [-1])
 
 
 # Usually it's a good idea to ignore gradients of loss for padding token predictions.
 # 
 # Because we don't care about further prediction after the pad_token is predicted for the first time, so it doesn't make sense to punish our network after the pad_token is predicted.
 # 
-# For simplicity you can ignore this comment, it's up to you.
+# So we mask out every prediction made from a pad_token input: the first pad_token of a name is still
+# a target (that's how the network learns to end names), but everything after it is ignored.
+
+# In[18]:
+
+
+# 1 for predictions we train on, 0 for predictions made after the end of the name
+loss_mask = tf.cast(tf.not_equal(input_sequence[:, :-1], token_to_id[pad_token]), tf.float32)
+loss_mask = tf.reshape(loss_mask, [-1])
+
 
 # In[19]:
 
 
-# Define the loss as categorical cross-entropy (e.g. from keras.losses).
-# Mind that predictions are probabilities and NOT logits!
-# Remember to apply tf.reduce_mean to get a scalar loss!
-from keras.objectives import categorical_crossentropy
-loss = tf.reduce_mean(categorical_crossentropy(answers_matrix, predictions_matrix))### YOUR CODE HERE
+# Define the loss as categorical cross-entropy.
+# Mind that predictions are logits and NOT probabilities!
+# Remember to average over unmasked predictions only to get a scalar loss!
+loss_per_token = tf.nn.sparse_softmax_cross_entropy_with_logits(
+    labels=answers_matrix, logits=predictions_matrix)
+loss = tf.reduce_sum(loss_per_token * loss_mask) / tf.reduce_sum(loss_mask)### YOUR CODE HERE
 
 optimize = tf.train.AdamOptimizer().minimize(loss)
 
@@ -262,16 +447,13 @@ optimize = tf.train.AdamOptimizer().minimize(loss)
 
 
 from IPython.display import clear_output
-from random import sample
 
 s.run(tf.global_variables_initializer())
 
-batch_size = 32
 history = []
 
 for i in range(1000):
-    batch = to_matrix(sample(names, batch_size), max_len=MAX_LENGTH)
-    loss_i, _ = s.run([loss, optimize], {input_sequence: batch})
+    loss_i, _ = s.run([loss, optimize])
     
     history.append(loss_i)
     
@@ -290,54 +472,134 @@ assert np.mean(history[:10]) > np.mean(history[-10:]), "RNN didn't converge"
 # In[21]:
 
 
-x_t = tf.placeholder(tf.int32, (1,))
-h_t = tf.Variable(np.zeros([1, rnn_num_units], np.float32))  # we will update hidden state in this variable
+# we generate a whole batch of samples at once, one row per sample
+x_t = tf.placeholder(tf.int32, (None,))
+# hidden state is kept in numpy between steps and fed back in, no variable assignment needed
+h_t = tf.placeholder(tf.float32, (None, rnn_num_units))
 
 # For sampling we need to define `rnn_one_step` tensors only once in our graph.
 # We reuse all parameters thanks to functional API usage.
 # Then we can feed appropriate tensor values using feed_dict in a loop.
-# Note how different it is from training stage, where we had to unroll the whole sequence for backprop.
-next_probs, next_h = rnn_one_step(x_t, h_t)
+# Note how different it is from training stage, where the whole sequence went through the RNN at once for backprop.
+next_logits, next_h = rnn_one_step(x_t, h_t)
+
+
+def gumbel_max(logits, u):
+    """
+    Gumbel-max trick: argmax of logits + gumbel noise is a sample from softmax(logits),
+    so the next token is drawn right in the graph without computing a softmax.
+    `u` is uniform noise in (0, 1) of the same shape as logits.
+    """
+    return tf.cast(tf.argmax(logits - tf.log(-tf.log(u)), axis=-1), tf.int32)
+
+
+# noise is generated on the device, so only the sampled ids leave it
+next_ix = gumbel_max(next_logits, tf.random_uniform(tf.shape(next_logits), minval=np.finfo(np.float32).tiny))
+
+# TFLite can't convert the random op, so the exported step takes uniform noise as an input instead
+u_t = tf.placeholder(tf.float32, (None, n_tokens))
+next_ix_from_noise = gumbel_max(next_logits, u_t)
+
+
+# The trained sampling step is tiny, so generation is bound by per-step overhead rather than by compute.
+# We freeze it into a TFLite model and run it with the TFLite interpreter.
+# `Optimize.DEFAULT` without a representative dataset is dynamic-range quantization: the input and recurrent
+# matrices are stored in int8, but tensors with fewer than 1024 elements stay float32, and so does the
+# embedding here (n_tokens x 16). Full integer quantization would also cover it, but it would quantize
+# the logits and the gumbel noise too and distort the sampled distribution.
+# cuDNN kernels can't be converted to TFLite, so with cuDNN we keep sampling in the session.
+
+# In[ ]:
+
+
+sampler = None
+noise_rng = np.random.default_rng()
+if not use_cudnn:
+    converter = tf.lite.TFLiteConverter.from_session(s, [x_t, h_t, u_t], [next_ix_from_noise, next_h])
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    sampler = tf.lite.Interpreter(model_content=converter.convert())
+    sampler.allocate_tensors()
+    sampler_index = {d['name']: d['index']
+                     for d in sampler.get_input_details() + sampler.get_output_details()}
+    x_index, h_index, u_index, ix_index, h_next_index = [
+        sampler_index[t.op.name] for t in (x_t, h_t, u_t, next_ix_from_noise, next_h)]
+
+
+def sampling_step(x, h):
+    """One rnn step for a batch of samples: returns sampled next token ids and next hidden state"""
+    if sampler is None:
+        return s.run([next_ix, next_h], {x_t: x, h_t: h})
+    
+    # the interpreter has fixed shapes, resize it when the number of samples changes
+    x_shape = next(d['shape'] for d in sampler.get_input_details() if d['index'] == x_index)
+    if x_shape[0] != len(x):
+        sampler.resize_tensor_input(x_index, [len(x)])
+        sampler.resize_tensor_input(h_index, [len(x), rnn_num_units])
+        sampler.resize_tensor_input(u_index, [len(x), n_tokens])
+        sampler.allocate_tensors()
+    
+    sampler.set_tensor(x_index, np.ascontiguousarray(x))
+    sampler.set_tensor(h_index, h)
+    # float32 noise drawn directly and kept away from 0 and 1, where the gumbel noise is infinite
+    u = noise_rng.random([len(x), n_tokens], dtype=np.float32)
+    sampler.set_tensor(u_index, np.clip(u, np.finfo(np.float32).tiny, 1 - np.finfo(np.float32).epsneg))
+    sampler.invoke()
+    return sampler.get_tensor(ix_index), sampler.get_tensor(h_next_index)
 
 
 # In[22]:
 
 
-def generate_sample(seed_phrase=start_token, max_length=MAX_LENGTH):
+def generate_samples(n, seed_phrase=start_token, max_length=MAX_LENGTH):
     '''
-    This function generates text given a `seed_phrase` as a seed.
+    This function generates `n` texts at once given a `seed_phrase` as a seed.
     Remember to include start_token in seed phrase!
     Parameter `max_length` is used to set the number of characters in prediction.
     '''
-    x_sequence = [token_to_id[token] for token in seed_phrase]
-    s.run(tf.assign(h_t, h_t.initial_value))
+    pad_id = token_to_id[pad_token]
+    # a seed phrase longer than max_length is returned as is
+    x_sequence = np.full([n, max(max_length, len(seed_phrase))], pad_id, np.int32)
+    x_sequence[:, :len(seed_phrase)] = [token_to_id[token] for token in seed_phrase]
+    h = np.zeros([n, rnn_num_units], np.float32)
+    ended = np.zeros(n, bool)
     
     # feed the seed phrase, if any
-    for ix in x_sequence[:-1]:
-         s.run(tf.assign(h_t, next_h), {x_t: [ix]})
+    for t in range(len(seed_phrase) - 1):
+         _, h = sampling_step(x_sequence[:, t], h)
     
     # start generating
-    for _ in range(max_length-len(seed_phrase)):
-        x_probs,_ = s.run([next_probs, tf.assign(h_t, next_h)], {x_t: [x_sequence[-1]]})
-        x_sequence.append(np.random.choice(n_tokens, p=x_probs[0]))
+    for t in range(len(seed_phrase), max_length):
+        x_sequence[:, t], h = sampling_step(x_sequence[:, t - 1], h)
         
-    return ''.join([tokens[ix] for ix in x_sequence if tokens[ix] != pad_token])
+        # the network is never trained past the first pad_token, so a name ends there:
+        # the rest of its row stays padding, and we stop once every name has ended
+        x_sequence[ended, t] = pad_id
+        ended |= x_sequence[:, t] == pad_id
+        if ended.all():
+            break
+        
+    return [''.join([tokens[ix] for ix in row if tokens[ix] != pad_token]) for row in x_sequence]
+
+
+def generate_sample(seed_phrase=start_token, max_length=MAX_LENGTH):
+    '''
+    This function generates text given a `seed_phrase` as a seed.
+    '''
+    return generate_samples(1, seed_phrase, max_length)[0]
 
 
 # In[23]:
 
 
 # without prefix
-for _ in range(10):
-    print(generate_sample())
+print('\n'.join(generate_samples(10)))
 
 
 # In[24]:
 
 
 # with prefix conditioning
-for _ in range(10):
-    print(generate_sample(' Trump'))
+print('\n'.join(generate_samples(10, ' Trump')))
 
 
 # # Submit to Coursera
@@ -354,7 +616,7 @@ COURSERA_EMAIL = "d****************m"
 
 
 from submit import submit_char_rnn
-samples = [generate_sample(' Al') for i in tqdm_utils.tqdm_notebook_failsafe(range(25))]
+samples = generate_samples(25, ' Al')
 submission = (history, samples)
 submit_char_rnn(submission, COURSERA_EMAIL, COURSERA_TOKEN)
 
@@ -387,34 +649,24 @@ submit_char_rnn(submission, COURSERA_EMAIL, COURSERA_TOKEN)
 # 
 # Apart from Keras, there's also a friendly TensorFlow API for recurrent neural nets. It's based around the symbolic loop function (aka [tf.scan](https://www.tensorflow.org/api_docs/python/tf/scan)).
 # 
-# RNN loop that we implemented for training can be replaced with single TensorFlow instruction: [tf.nn.dynamic_rnn](https://www.tensorflow.org/api_docs/python/tf/nn/dynamic_rnn).
+# The RNN loop that we use for training is a single TensorFlow instruction: [tf.nn.dynamic_rnn](https://www.tensorflow.org/api_docs/python/tf/nn/dynamic_rnn).
 # This interface allows for dynamic sequence length and comes with some pre-implemented architectures.
 # 
 # Take a look at [tf.nn.rnn_cell.BasicRNNCell](https://www.tensorflow.org/api_docs/python/tf/contrib/rnn/BasicRNNCell).
+# 
+# `CustomRNN` from the training loop above works for any sequence length:
 
 # In[27]:
 
 
-class CustomRNN(tf.nn.rnn_cell.BasicRNNCell):
-    def call(self, input, state):
-        # from docs:
-        # Returns:
-        # Output: A 2-D tensor with shape [batch_size, self.output_size].
-        # New state: Either a single 2-D tensor, or a tuple of tensors matching the arity and shapes of state.
-        return rnn_one_step(input[:, 0], state)
-    
-    @property
-    def output_size(self):
-        return n_tokens
-    
 cell = CustomRNN(rnn_num_units)
 
 input_sequence = tf.placeholder(tf.int32, (None, None))
     
-predicted_probas, last_state = tf.nn.dynamic_rnn(cell, input_sequence[:, :, None], dtype=tf.float32)
+state_sequence, last_state = tf.nn.dynamic_rnn(cell, embed_x(input_sequence), dtype=tf.float32)
 
-print('LSTM outputs for each step [batch,time,n_tokens]:')
-print(predicted_probas.eval({input_sequence: to_matrix(names[:10], max_len=50)}).shape)
+print('RNN hidden state for each step [batch,time,rnn_num_units]:')
+print(state_sequence.eval({input_sequence: to_matrix(names[:10], max_len=50)}).shape)
 
 
 # Note that we never used MAX_LENGTH in the code above: TF will iterate over however many time-steps you gave it.
@@ -424,7 +676,7 @@ print(predicted_probas.eval({input_sequence: to_matrix(names[:10], max_len=50)})
 # In[28]:
 
 
-for obj in dir(tf.nn.rnn_cell) + dir(tf.contrib.rnn):
+for obj in dir(tf.nn.rnn_cell) + (dir(tf.contrib.rnn) if hasattr(tf, 'contrib') else []):
     if obj.endswith('Cell'):
         print(obj, end="\t")
 